@@ -1,9 +1,14 @@
 # bolsa_basico.py
 # Instala primero: pip install yfinance pandas
 
+import io
+
 import yfinance as yf
 import pandas as pd
-import requests
+from curl_cffi import requests as curl_requests
+
+# Una sola sesión (conexiones reutilizadas) para Stooq y Yahoo
+SESION = curl_requests.Session(impersonate="chrome")
 
 def descargar_datos2(ticker: str, periodo: str = "1mo", intervalo: str = "1d") -> pd.DataFrame:
     """
@@ -11,13 +16,13 @@ def descargar_datos2(ticker: str, periodo: str = "1mo", intervalo: str = "1d") -
     periodo: "5d", "1mo", "3mo", "6mo", "1y", "5y", "max"
     intervalo: "1m", "5m", "15m", "1h", "1d", "1wk", "1mo"
     """
-    df = yf.download(tickers=ticker, period=periodo, interval=intervalo, auto_adjust=False, progress=False)
+    df = yf.download(tickers=ticker, period=periodo, interval=intervalo, auto_adjust=False, progress=False, session=SESION)
     if df.empty:
         raise ValueError(f"No se han devuelto datos para '{ticker}'. ¿Ticker correcto?")
     df = df.reset_index()  # para que la fecha sea una columna normal
     return df
 def descargar_datos3(ticker, periodo="1mo", intervalo="1d"):
-    t = yf.Ticker(ticker)
+    t = yf.Ticker(ticker, session=SESION)
     df = t.history(period=periodo, interval=intervalo)
 
     if df.empty:
@@ -25,49 +30,56 @@ def descargar_datos3(ticker, periodo="1mo", intervalo="1d"):
 
     return df.reset_index()
 
-def descargar_datos(ticker, periodo="1mo", intervalo="1d"):
-    # url = "https://www.bolsasymercados.es/bme-exchange/es/Mercados-y-Cotizaciones/Acciones/Mercado-Continuo/Ficha/Banco-Santander-ES0113900J37"
-    # html = requests.get(url, timeout=20, headers={"User-Agent": "Mozilla/5.0"}).text
-    # print("Longitud HTML:", len(html))
-    # print(html[:2200])
-
-    
-
-    # session = requests.Session()
-    # session.headers.update({
-    #     "User-Agent": "Mozilla/5.0",
-    #     "Accept": "application/json",
-    #     "Referer": "https://www.bolsasymercados.es/"
-    # })
-
-    # # 1️⃣ Petición inicial para obtener cookies
-    # session.get("https://www.bolsasymercados.es/bme-exchange/es/", timeout=20)
-
-    # # 2️⃣ Endpoint REAL con parámetros
-    # isin = "ES0113900J37"
+# Stooq solo ofrece velas diarias, semanales o mensuales
+INTERVALOS_STOOQ = {"1d": "d", "1wk": "w", "1mo": "m"}
 
-    # url = "https://www.bolsasymercados.es/bme-exchange/api/v1/trading/securities/price-history"
+# Periodos (estilo Yahoo) -> cuánto histórico se conserva; None = todo
+PERIODOS_STOOQ = {
+    "5d": pd.DateOffset(days=5),
+    "1mo": pd.DateOffset(months=1),
+    "3mo": pd.DateOffset(months=3),
+    "6mo": pd.DateOffset(months=6),
+    "1y": pd.DateOffset(years=1),
+    "5y": pd.DateOffset(years=5),
+    "max": None,
+}
 
-    # params = {
-    #     "isin": isin,
-    #     "market": "MC",
-    #     "from": "2023-01-01",
-    #     "to": "2025-12-31"
-    # }
 
-    # r = session.get(url, params=params, timeout=20)
-
-    # # 🔎 DEBUG
-    # print("Status:", r.status_code)
-    # print("Content-Type:", r.headers.get("Content-Type"))
+def simbolo_stooq(ticker):
+    """
+    "SAN.MC" / "SAN" -> "san": Stooq usa el símbolo sin el sufijo de Yahoo.
+    """
+    simbolo = ticker.strip().upper()
+    if simbolo.endswith(".MC"):
+        simbolo = simbolo[:-3]
+    if not simbolo.isalnum():
+        raise ValueError(f"Ticker no válido para Stooq: '{ticker}'")
+    return simbolo.lower()
 
-    # data = r.json()   # ← ahora SÍ
-    # CSV diario desde Stooq (sin API key)
-    url = "https://stooq.com/q/d/l/?s=san&i=d"   # i=d diario, i=w semanal, i=m mensual
-    df = pd.read_csv(url)
 
-    print(df.head())
-    df.to_csv("SAN_stooq.csv", index=False)
+def descargar_datos(ticker, periodo="1mo", intervalo="1d", save_path=None):
+    """
+    CSV histórico desde Stooq (sin API key). Devuelve el DataFrame con las
+    filas del periodo pedido y solo lo escribe a disco si se pasa save_path.
+    """
+    if intervalo not in INTERVALOS_STOOQ:
+        raise ValueError(f"Intervalo no soportado por Stooq: '{intervalo}'")
+    if periodo not in PERIODOS_STOOQ:
+        raise ValueError(f"Periodo no soportado: '{periodo}'")
+
+    url = "https://stooq.com/q/d/l/"
+    params = {"s": simbolo_stooq(ticker), "i": INTERVALOS_STOOQ[intervalo]}
+    r = SESION.get(url, params=params, timeout=20)
+    r.raise_for_status()
+    df = pd.read_csv(io.BytesIO(r.content), parse_dates=["Date"])
+
+    desde = PERIODOS_STOOQ[periodo]
+    if desde is not None and not df.empty:
+        df = df[df["Date"] >= df["Date"].max() - desde].reset_index(drop=True)
+
+    if save_path:
+        df.to_csv(save_path, index=False)
+    return df
 
 def main():
     ticker = "SAN.MC" #input("Ticker (ej: AAPL, MSFT, SAN.MC): ").strip().upper()
@@ -1,48 +1,107 @@
 from __future__ import annotations
 
-import io
+import atexit
+import hashlib
 import json
 import os
+import queue
+import re
 import sqlite3
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from dataclasses import dataclass
-from datetime import datetime
+from functools import lru_cache
+from itertools import groupby
+from datetime import datetime, timezone
 from pathlib import Path
-from typing import Dict, Iterable, List, Optional, Tuple, Union
+from types import MappingProxyType
+from typing import Dict, Iterable, Iterator, List, Mapping, Optional, Tuple, Union
 
-import matplotlib
-matplotlib.use("Agg")  # servidor sin UI
-import matplotlib.pyplot as plt
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+import numpy as np
 import pandas as pd
 import yfinance as yf
+from curl_cffi import requests as curl_requests
 
 from flask import (
     Flask,
     Response,
     abort,
     flash,
+    g,
     redirect,
     render_template,
     request,
     session,
     url_for,
 )
+from flask.sessions import SecureCookieSessionInterface
 
 # =========================
 # Configuración general
 # =========================
 
 RUTA_DB = "database.db"
-RUTA_RESULTADOS = "resultados.json"
+RUTA_RESULTADOS = "resultados"  # carpeta: un parquet por (ticker, periodo)
 RUTA_LAST_CHECK = "last_check.json"
 RUTA_MARKET_REFRESH = "market_refresh.json"  # NUEVO: controla TTL de refresh
+RUTA_REFRESH_LOCK = "market_refresh.lock"  # flock compartido entre workers
 
 CLAVE_SESION = os.environ["SECRET_KEY"] # CLAVE_SESION = os.environ.get("SECRET_KEY", "cambia-esto-por-una-clave-segura")
 COMISION_POR_OPERACION = 10.0
 
+# dtypes con los que se guardan los datos de mercado
+TIPOS_OHLCV = {
+    "Open": "float64",
+    "High": "float64",
+    "Low": "float64",
+    "Close": "float64",
+    "Adj Close": "float64",
+    "Volume": "int64",
+}
+
+# Conexiones SQLite abiertas que se reutilizan entre peticiones
+TAMANO_POOL_DB = int(os.environ.get("DB_POOL_SIZE", "8"))
+
+# Puntos que se dibujan en cada mini-gráfica
+PUNTOS_MINI_GRAFICA = 60
+# Rango admitido en /mini_grafica?puntos= (acota las claves de su cache)
+PUNTOS_MINI_GRAFICA_MIN = 20
+PUNTOS_MINI_GRAFICA_MAX = 120
+
+# Yahoo no acepta más de ~20 símbolos por petición en yf.download
+TAMANO_BLOQUE_YF = 20
+
+# Descargas (periodo, bloque) simultáneas como máximo al refrescar
+MAX_HILOS_DESCARGA = 16
+
 # TTL para no bajar datos todo el rato (en Railway te salva los tests)
 MARKET_REFRESH_TTL_SECONDS = int(os.environ.get("MARKET_TTL_SECONDS", "900"))  # 15 min por defecto
 
+# Segundos que se reutiliza un precio "en tiempo real" ya descargado
+PRECIO_TTL_SECONDS = int(os.environ.get("PRECIO_TTL_SECONDS", "30"))
+
+# Segundos que el navegador puede reutilizar una mini-gráfica sin revalidar
+MINI_GRAFICA_MAX_AGE = 30
+# ... y la de un ticker sin datos, que no depende del usuario ni de los datos
+MINI_GRAFICA_VACIA_MAX_AGE = 300
+
+# Segundos que se reutiliza la lista de tickers leída de la DB
+TICKERS_TTL_SECONDS = 60
+
+# Con la cache de mercado caducada, cada cuánto se mira si otro worker la
+# ha refrescado (releyendo market_refresh.json)
+RELECTURA_REFRESH_SEGUNDOS = 5
+
+# Antigüedad máxima del refresco de mercado para operar con su último cierre
+PRECIO_DESDE_MERCADO_SEGUNDOS = 60
+
 # Mapeo de periodos (siguiendo tu estructura)
 INTERVALO_PERIODO = [
     ["D",   "1d",  "1m"],   # 1 día, 1m
@@ -51,7 +110,24 @@ INTERVALO_PERIODO = [
     ["MAX", "max", "1d"],   # toda la vida, 1d
 ]
 
-TODOS_LOS_DATOS = []
+# Claves de periodo en orden (para el selector) y como conjunto (para validar)
+PERIODOS = tuple(p[0] for p in INTERVALO_PERIODO)
+PERIODOS_VALIDOS = frozenset(PERIODOS)
+
+# Datos de mercado ya cargados en memoria (None = aún sin leer de disco) y
+# versión de disco con la que se leyeron: (st_mtime_ns, st_ino) del fichero
+# RUTA_RESULTADOS/VERSION, que se reescribe (os.replace) después de todos los
+# parquet. El inodo cambia en cada escritura aunque el mtime sea grueso.
+_DATA_LOCK = threading.Lock()
+_DATA_CACHE: Optional[Dict[str, Dict[str, pd.DataFrame]]] = None
+_DATA_VERSION: Tuple[int, int] = (0, 0)
+# Último cierre por (ticker, periodo), calculado una vez al cargar _DATA_CACHE
+_ULTIMOS_CIERRES: Dict[Tuple[str, str], float] = {}
+
+# Sesión HTTP compartida para Yahoo: reutiliza conexiones (keep-alive) en vez
+# de pagar TCP+TLS en cada petición. curl_cffi porque Yahoo bloquea clientes
+# que no parecen un navegador; cada hilo obtiene su propio handle de curl.
+SESION_YF = curl_requests.Session(impersonate="chrome")
 
 
 # =========================
@@ -74,6 +150,7 @@ class RegistroTickerUI:
     beneficio: Optional[float]
     tp: Optional[float]
     sl: Optional[float]
+    mini_svg: str = ""
 
 
 def ahora_iso() -> str:
@@ -84,6 +161,10 @@ def existe_archivo(ruta: str) -> bool:
     return Path(ruta).is_file()
 
 
+def existe_directorio(ruta: str) -> bool:
+    return Path(ruta).is_dir()
+
+
 def leer_json(ruta: str) -> dict:
     if not existe_archivo(ruta):
         return {}
@@ -96,7 +177,73 @@ def leer_json(ruta: str) -> dict:
 
 def guardar_json(ruta: str, data: dict) -> None:
     with open(ruta, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2, default=str)
+        json.dump(data, f, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+def plegar_movimientos(es_compra: np.ndarray, cantidades: np.ndarray, costes: np.ndarray) -> Tuple[int, float]:
+    """
+    Acciones y coste medio resultantes de una secuencia ordenada de
+    movimientos (coste = precio * cantidad + comisión en las compras).
+    Sin ventas se resuelve vectorizado; con ventas hace falta recorrerla
+    porque la posición puede volver a cero y reiniciar el coste.
+    """
+    if es_compra.all():
+        # Las compras con la posición aún a cero no acumulan coste
+        validas = np.cumsum(cantidades) > 0
+        shares = int(cantidades.sum())
+        if shares <= 0:
+            return 0, 0.0
+        return shares, float(costes[validas].sum()) / shares
+
+    shares = 0
+    avg_cost = 0.0
+
+    for compra, qty, coste in zip(es_compra.tolist(), cantidades.tolist(), costes.tolist()):
+        if compra:
+            total_cost = avg_cost * shares + coste
+            shares += qty
+            avg_cost = (total_cost / shares) if shares > 0 else 0.0
+        else:
+            shares -= qty
+            if shares <= 0:
+                shares = 0
+                avg_cost = 0.0
+
+    return shares, float(avg_cost)
+
+
+# Tickers de la Bolsa de Madrid (sin el sufijo .MC): letras, dígitos, "." y "-"
+PATRON_TICKER = re.compile(r"[A-Z0-9][A-Z0-9.\-]{0,11}")
+
+
+def leer_mayusculas(valores: Mapping[str, str], clave: str, defecto: str = "") -> str:
+    """
+    Campo de formulario/query sin espacios y en mayúsculas, o defecto si
+    viene vacío.
+    """
+    texto = (valores.get(clave) or "").strip()
+    return texto.upper() if texto else defecto
+
+
+def leer_ticker(valores: Mapping[str, str], clave: str = "ticker") -> str:
+    """
+    Ticker normalizado; "" si falta o no tiene pinta de ticker.
+    """
+    ticker = leer_mayusculas(valores, clave)
+    return ticker if PATRON_TICKER.fullmatch(ticker) else ""
+
+
+def leer_entero(valores: Mapping[str, str], clave: str, defecto: int, minimo: int = 1) -> Optional[int]:
+    """
+    Entero >= minimo (defecto si el campo no viene); None si no es un entero.
+    """
+    texto = (valores.get(clave) or "").strip()
+    if not texto:
+        return max(minimo, defecto)
+    try:
+        return max(minimo, int(texto))
+    except ValueError:
+        return None
 
 
 def normalizar_float_texto(s: str) -> Optional[float]:
@@ -113,15 +260,156 @@ def normalizar_float_texto(s: str) -> Optional[float]:
 # Capa de Base de Datos (sin cambiar tu DB)
 # =========================
 
+# WAL: los lectores no bloquean al escritor y cada commit no hace fsync.
+# El resto: temporales en RAM, lecturas vía mmap (256 MB) y 64 MB de caché.
+PRAGMAS_SQLITE = (
+    "journal_mode=WAL",
+    "synchronous=NORMAL",
+    "temp_store=MEMORY",
+    "mmap_size=268435456",
+    "cache_size=-65536",
+)
+
+# SQL de las escrituras frecuentes como constantes: el mismo texto en cada
+# llamada permite que la cache de sentencias de sqlite3 reutilice el prepare.
+SQL_SET_POSICION = """
+    INSERT INTO posiciones(symbol, cantidad) VALUES(?, ?)
+    ON CONFLICT(symbol) DO UPDATE SET cantidad=excluded.cantidad
+"""
+
+SQL_INSERT_COMPRA = """
+    INSERT INTO compras(usuario, ticker, cantidad, "precio compra", "fecha compra")
+    VALUES(?, ?, ?, ?, ?)
+"""
+
+SQL_SET_SALDO = 'UPDATE user SET saldo = ? WHERE id = ?'
+
+# posicion_resumen guarda acciones y coste medio por (usuario, ticker) para no
+# recorrer todo el histórico de compras en cada render.
+SQL_RESUMEN_COMPRA = """
+    INSERT INTO posicion_resumen(usuario, ticker, shares, avg_cost)
+    VALUES(:usuario, :ticker, :cantidad, CASE WHEN :cantidad > 0 THEN :coste / :cantidad ELSE 0.0 END)
+    ON CONFLICT(usuario, ticker) DO UPDATE SET
+        shares = shares + :cantidad,
+        avg_cost = CASE WHEN shares + :cantidad > 0
+                        THEN (avg_cost * shares + :coste) / (shares + :cantidad)
+                        ELSE 0.0 END
+"""
+
+SQL_RESUMEN_VENTA = """
+    UPDATE posicion_resumen
+    SET shares = MAX(shares - :cantidad, 0),
+        avg_cost = CASE WHEN shares - :cantidad <= 0 THEN 0.0 ELSE avg_cost END
+    WHERE usuario = :usuario AND ticker = :ticker
+"""
+
+# Una venta parcial parte el lote: la parte vendida se inserta como fila nueva
+# de compras y su "ID" se anota en compras_partidas, porque esa fila no es una
+# compra real y no paga comisión.
+SQL_CREAR_PARTIDAS = "CREATE TABLE IF NOT EXISTS compras_partidas (id INTEGER PRIMARY KEY)"
+
+# Solo al crear compras_partidas sobre una DB antigua: las partes de ventas
+# anteriores se reconocen por repetir fecha y precio de compra de un "ID"
+# anterior y estar cerradas (la mejor aproximación sin más datos).
+SQL_SEMBRAR_PARTIDAS = """
+    INSERT OR IGNORE INTO compras_partidas(id)
+    SELECT "ID"
+    FROM (
+        SELECT "ID", "fecha venta", ROW_NUMBER() OVER (
+            PARTITION BY usuario, ticker, "fecha compra", "precio compra" ORDER BY "ID"
+        ) AS n
+        FROM compras
+    )
+    WHERE n > 1 AND COALESCE("fecha venta", '') <> ''
+"""
+
+# Histórico de compras como movimientos ordenados. Cada fila es una compra y,
+# si está cerrada, también una venta. La comisión cuenta una vez por compra
+# real (filas que no están en compras_partidas).
+SQL_MOVIMIENTOS = """
+    SELECT c.usuario, c.ticker, 1 AS es_compra, c.cantidad,
+           c.cantidad * c."precio compra" + CASE WHEN p.id IS NULL THEN :comision ELSE 0.0 END AS coste,
+           c."fecha compra" AS fecha, 0 AS orden, c."ID" AS id
+    FROM compras AS c
+    LEFT JOIN compras_partidas AS p ON p.id = c."ID"
+    WHERE c."precio compra" IS NOT NULL AND COALESCE(c."fecha compra", '') <> ''
+    UNION ALL
+    SELECT usuario, ticker, 0, cantidad, 0.0, "fecha venta", 1, "ID"
+    FROM compras
+    WHERE COALESCE("fecha venta", '') <> ''
+    ORDER BY usuario, ticker, fecha, orden, id
+"""
+
+
 class RepositorioDB:
     def __init__(self, ruta_db: str):
         self.ruta_db = ruta_db
 
-    def conectar(self) -> sqlite3.Connection:
-        conn = sqlite3.connect(self.ruta_db)
+        # (caducidad en time.monotonic(), tickers, empresa por ticker, tickers ordenados)
+        self._lock_tickers = threading.Lock()
+        self._tickers_cache: Optional[
+            Tuple[float, List[Tuple[str, str]], Mapping[str, str], Tuple[str, ...]]
+        ] = None
+
+    def conectar(self, compartida: bool = False) -> sqlite3.Connection:
+        """
+        compartida=True: la conexión puede pasar entre hilos (la usa el pool,
+        que garantiza que solo un hilo la tiene a la vez).
+        """
+        conn = sqlite3.connect(self.ruta_db, cached_statements=256, check_same_thread=not compartida)
         conn.row_factory = sqlite3.Row
+        for pragma in PRAGMAS_SQLITE:
+            conn.execute(f"PRAGMA {pragma}")
         return conn
 
+    def asegurar_esquema(self, conn: sqlite3.Connection) -> None:
+        """
+        Índices y tablas auxiliares que necesita la app sobre la DB existente
+        (idempotente). posicion_resumen solo se reconstruye desde compras si
+        está vacía (recién creada): después la mantienen las operaciones.
+        """
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_tickers_ticker ON tickers(ticker)")
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_compras_usuario_ticker ON compras(usuario, ticker, "fecha compra")')
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS posicion_resumen (
+                usuario INTEGER,
+                ticker TEXT,
+                shares INTEGER,
+                avg_cost REAL,
+                PRIMARY KEY (usuario, ticker)
+            )
+            """
+        )
+        conn.commit()
+
+        # Dentro de la transacción para que dos workers que arrancan a la vez
+        # no reconstruyan los dos, ni se pierda una operación a medias.
+        with self.transaccion(conn):
+            existia = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'compras_partidas'"
+            ).fetchone()
+            conn.execute(SQL_CREAR_PARTIDAS)
+            if not existia:
+                conn.execute(SQL_SEMBRAR_PARTIDAS)
+            if conn.execute("SELECT 1 FROM posicion_resumen LIMIT 1").fetchone() is None:
+                self.db_reconstruir_resumen(conn)
+
+    @contextmanager
+    def transaccion(self, conn: sqlite3.Connection) -> Iterator[sqlite3.Connection]:
+        """
+        Lecturas y escrituras de una operación en una sola transacción:
+        BEGIN IMMEDIATE toma el lock de escritura al principio (sin
+        SQLITE_BUSY a mitad) y se hace un único COMMIT, o ROLLBACK si falla.
+        """
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
     # ---- user ----
     def db_get_usuario(self, conn: sqlite3.Connection, usuario_id: int) -> Tuple[str, float]:
         cur = conn.cursor()
@@ -141,7 +429,7 @@ class RepositorioDB:
 
     def db_set_saldo(self, conn: sqlite3.Connection, usuario_id: int, nuevo_saldo: float) -> None:
         cur = conn.cursor()
-        cur.execute('UPDATE user SET saldo = ? WHERE id = ?', (float(nuevo_saldo), usuario_id))
+        cur.execute(SQL_SET_SALDO, (float(nuevo_saldo), usuario_id))
 
     def db_existe_usuario(self, conn: sqlite3.Connection, usuario_id: int) -> bool:
         cur = conn.cursor()
@@ -150,10 +438,37 @@ class RepositorioDB:
 
     # ---- tickers ----
     def leer_tickers(self, conn: sqlite3.Connection) -> List[Tuple[str, str]]:
+        """
+        La lista casi nunca cambia: se memoiza TICKERS_TTL_SECONDS.
+        """
+        return list(self._memo_tickers(conn)[1])
+
+    def leer_empresas(self, conn: sqlite3.Connection) -> Tuple[Mapping[str, str], Tuple[str, ...]]:
+        """
+        Empresa por ticker (solo lectura) y tickers ya ordenados, del mismo
+        memo que leer_tickers.
+        """
+        memo = self._memo_tickers(conn)
+        return memo[2], memo[3]
+
+    def _memo_tickers(
+        self, conn: sqlite3.Connection
+    ) -> Tuple[float, List[Tuple[str, str]], Mapping[str, str], Tuple[str, ...]]:
+        with self._lock_tickers:
+            memo = self._tickers_cache
+        if memo is not None and memo[0] > time.monotonic():
+            return memo
+
         cur = conn.cursor()
-        # cur.execute("SELECT empresa, ticker FROM tickers")
-        cur.execute("SELECT empresa, ticker FROM tickers where ticker='SAN'")
-        return [(str(r[0]), str(r[1])) for r in cur.fetchall()]
+        cur.execute("SELECT empresa, ticker FROM tickers")
+        tickers = [(str(r[0]), str(r[1])) for r in cur.fetchall()]
+        # El memo se comparte entre peticiones: el dict va envuelto en un
+        # proxy de solo lectura para que nadie pueda modificarlo
+        empresas = MappingProxyType({t: e for e, t in tickers})
+        memo = (time.monotonic() + TICKERS_TTL_SECONDS, tickers, empresas, tuple(sorted(empresas)))
+        with self._lock_tickers:
+            self._tickers_cache = memo
+        return memo
 
     # ---- posiciones ----
     def db_get_posiciones(self, conn: sqlite3.Connection) -> Dict[str, int]:
@@ -163,23 +478,20 @@ class RepositorioDB:
 
     def db_set_posicion(self, conn: sqlite3.Connection, ticker: str, cantidad: int) -> None:
         cur = conn.cursor()
-        cur.execute(
-            """
-            INSERT INTO posiciones(symbol, cantidad) VALUES(?, ?)
-            ON CONFLICT(symbol) DO UPDATE SET cantidad=excluded.cantidad
-            """,
-            (ticker, int(cantidad)),
-        )
+        cur.execute(SQL_SET_POSICION, (ticker, int(cantidad)))
 
     # ---- compras ----
     def db_insert_compra(self, conn: sqlite3.Connection, usuario_id: int, ticker: str, cantidad: int, precio: float) -> None:
         cur = conn.cursor()
+        cur.execute(SQL_INSERT_COMPRA, (usuario_id, ticker, int(cantidad), float(precio), ahora_iso()))
         cur.execute(
-            """
-            INSERT INTO compras(usuario, ticker, cantidad, "precio compra", "fecha compra")
-            VALUES(?, ?, ?, ?, ?)
-            """,
-            (usuario_id, ticker, int(cantidad), float(precio), ahora_iso()),
+            SQL_RESUMEN_COMPRA,
+            {
+                "usuario": usuario_id,
+                "ticker": ticker,
+                "cantidad": int(cantidad),
+                "coste": float(precio) * int(cantidad) + COMISION_POR_OPERACION,
+            },
         )
 
     def db_cerrar_compras(
@@ -198,6 +510,11 @@ class RepositorioDB:
         fecha_venta = ahora_iso()
         order = "DESC" if metodo.upper() == "LIFO" else "ASC"
         cur = conn.cursor()
+        cur.row_factory = None  # tuplas: se desempaquetan por posición
+
+        # Lectura y escrituras en una sola transacción con el lock de escritura
+        if not conn.in_transaction:
+            cur.execute("BEGIN IMMEDIATE")
 
         cur.execute(
             f"""
@@ -213,38 +530,27 @@ class RepositorioDB:
         abiertas = cur.fetchall()
         restante = cantidad_vender
 
-        for row in abiertas:
+        # Primero se calcula el plan en memoria y luego se ejecuta en bloque
+        cierres: List[Tuple[float, str, int]] = []
+        recortes: List[Tuple[int, int]] = []
+        inserciones: List[Tuple[int, str, int, Optional[float], str, str, float]] = []
+
+        for id_, qty, p_compra, f_compra, _sup, _inf in abiertas:
             if restante <= 0:
                 break
 
-            id_ = int(row["ID"])
-            qty = int(row["cantidad"])
-            p_compra = row["precio compra"]
-            f_compra = row["fecha compra"]
+            id_ = int(id_)
+            qty = int(qty)
 
             if qty <= restante:
-                cur.execute(
-                    """
-                    UPDATE compras
-                    SET "precio venta" = ?, "fecha venta" = ?,
-                        "precio venta automatico sup" = NULL,
-                        "precio venta automatico inf" = NULL
-                    WHERE "ID" = ?
-                    """,
-                    (float(precio_venta), fecha_venta, id_),
-                )
+                cierres.append((float(precio_venta), fecha_venta, id_))
                 restante -= qty
             else:
                 vendidas = restante
                 quedan = qty - vendidas
 
-                cur.execute('UPDATE compras SET cantidad = ? WHERE "ID" = ?', (quedan, id_))
-
-                cur.execute(
-                    """
-                    INSERT INTO compras(usuario, ticker, cantidad, "precio compra", "fecha compra", "fecha venta", "precio venta")
-                    VALUES(?, ?, ?, ?, ?, ?, ?)
-                    """,
+                recortes.append((quedan, id_))
+                inserciones.append(
                     (
                         usuario_id,
                         ticker,
@@ -253,55 +559,105 @@ class RepositorioDB:
                         f_compra,
                         fecha_venta,
                         float(precio_venta),
-                    ),
+                    )
                 )
                 restante = 0
 
         if restante > 0:
             raise ValueError(f"No hay suficientes compras abiertas para vender {cantidad_vender}. Faltan {restante}.")
 
+        cur.executemany(
+            """
+            UPDATE compras
+            SET "precio venta" = ?, "fecha venta" = ?,
+                "precio venta automatico sup" = NULL,
+                "precio venta automatico inf" = NULL
+            WHERE "ID" = ?
+            """,
+            cierres,
+        )
+        cur.executemany('UPDATE compras SET cantidad = ? WHERE "ID" = ?', recortes)
+        for fila in inserciones:
+            cur.execute(
+                """
+                INSERT INTO compras(usuario, ticker, cantidad, "precio compra", "fecha compra", "fecha venta", "precio venta")
+                VALUES(?, ?, ?, ?, ?, ?, ?)
+                """,
+                fila,
+            )
+            cur.execute("INSERT INTO compras_partidas(id) VALUES(?)", (cur.lastrowid,))
+        cur.execute(SQL_RESUMEN_VENTA, {"usuario": usuario_id, "ticker": ticker, "cantidad": cantidad_vender})
+
     def db_coste_medio_posicion(self, conn: sqlite3.Connection, usuario_id: int, ticker: str) -> float:
         cur = conn.cursor()
         cur.execute(
-            """
-            SELECT cantidad, "precio compra", "fecha compra", "precio venta", "fecha venta"
-            FROM compras
-            WHERE usuario = ? AND ticker = ?
-            """,
+            "SELECT avg_cost FROM posicion_resumen WHERE usuario = ? AND ticker = ?",
             (usuario_id, ticker),
         )
-        rows = cur.fetchall()
-
-        movimientos = []
-        for r in rows:
-            cantidad = int(r["cantidad"])
-            p_compra = r["precio compra"]
-            f_compra = r["fecha compra"]
-            p_venta = r["precio venta"]
-            f_venta = r["fecha venta"]
-
-            if p_compra is not None and f_compra:
-                movimientos.append(("BUY", str(f_compra), cantidad, float(p_compra)))
-            elif p_venta is not None and f_venta:
-                movimientos.append(("SELL", str(f_venta), cantidad, float(p_venta)))
-
-        movimientos.sort(key=lambda x: x[1])
-
-        shares = 0
-        avg_cost = 0.0
-
-        for tipo, _, qty, price in movimientos:
-            if tipo == "BUY":
-                total_cost = avg_cost * shares + price * qty + COMISION_POR_OPERACION
-                shares += qty
-                avg_cost = (total_cost / shares) if shares > 0 else 0.0
-            else:
-                shares -= qty
-                if shares <= 0:
-                    shares = 0
-                    avg_cost = 0.0
+        row = cur.fetchone()
+        return float(row[0] or 0.0) if row else 0.0
 
-        return float(avg_cost)
+    def db_reconstruir_resumen(self, conn: sqlite3.Connection) -> None:
+        """
+        Recalcula posicion_resumen entera a partir del histórico de compras.
+        El lock de escritura se toma antes de leer: ninguna compra/venta de
+        otro proceso puede colarse entre la lectura y el DELETE.
+        """
+        cur = conn.cursor()
+        cur.row_factory = None
+        if not conn.in_transaction:
+            cur.execute("BEGIN IMMEDIATE")
+        cur.execute(SQL_MOVIMIENTOS, {"comision": COMISION_POR_OPERACION})
+        filas = cur.fetchall()
+
+        resumen = []
+        for (usuario, ticker), grupo in groupby(filas, key=lambda r: (r[0], r[1])):
+            _, _, es_compra, cantidades, costes, *_ = zip(*grupo)
+            shares, avg_cost = plegar_movimientos(
+                np.array(es_compra, dtype=bool),
+                np.array(cantidades, dtype=np.int64),
+                np.array(costes, dtype=np.float64),
+            )
+            resumen.append((usuario, ticker, shares, avg_cost))
+
+        cur.execute("DELETE FROM posicion_resumen")
+        cur.executemany(
+            "INSERT INTO posicion_resumen(usuario, ticker, shares, avg_cost) VALUES(?, ?, ?, ?)",
+            resumen,
+        )
+
+    def db_coste_medio_todos(self, conn: sqlite3.Connection, usuario_id: int) -> Dict[str, float]:
+        cur = conn.cursor()
+        cur.execute("SELECT ticker, avg_cost FROM posicion_resumen WHERE usuario = ?", (usuario_id,))
+        return {str(ticker): float(avg_cost or 0.0) for ticker, avg_cost in cur.fetchall()}
+
+    def db_get_auto_todos(self, conn: sqlite3.Connection, usuario_id: int) -> Dict[str, Tuple[Optional[float], Optional[float]]]:
+        """
+        TP/SL de la compra abierta más reciente de cada ticker, en una consulta.
+        """
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT ticker, sup, inf
+            FROM (
+                SELECT ticker,
+                       "precio venta automatico sup" AS sup,
+                       "precio venta automatico inf" AS inf,
+                       ROW_NUMBER() OVER (PARTITION BY ticker ORDER BY "fecha compra" DESC, "ID" DESC) AS n
+                FROM compras
+                WHERE usuario = ? AND "fecha venta" IS NULL
+            )
+            WHERE n = 1
+            """,
+            (usuario_id,),
+        )
+        return {
+            str(ticker): (
+                float(sup) if sup is not None else None,
+                float(inf) if inf is not None else None,
+            )
+            for ticker, sup, inf in cur.fetchall()
+        }
 
     def db_get_auto_venta_compra_activa(self, conn: sqlite3.Connection, usuario_id: int, ticker: str) -> Tuple[Optional[float], Optional[float]]:
         cur = conn.cursor()
@@ -311,7 +667,7 @@ class RepositorioDB:
             FROM compras
             WHERE usuario = ? AND ticker = ?
               AND "fecha venta" IS NULL
-            ORDER BY "fecha compra" DESC
+            ORDER BY "fecha compra" DESC, "ID" DESC
             LIMIT 1
             """,
             (usuario_id, ticker),
@@ -342,7 +698,7 @@ class RepositorioDB:
                 FROM compras
                 WHERE usuario = ? AND ticker = ?
                   AND "fecha venta" IS NULL
-                ORDER BY "fecha compra" DESC
+                ORDER BY "fecha compra" DESC, "ID" DESC
                 LIMIT 1
             )
             """,
@@ -353,6 +709,38 @@ class RepositorioDB:
         self.db_set_auto_venta_compra_activa(conn, usuario_id, ticker, None, None)
 
 
+class PoolConexiones:
+    """
+    Conexiones SQLite abiertas una vez (con sus PRAGMAs) y reutilizadas entre
+    peticiones. Con tamano=1 todas las peticiones comparten una sola conexión,
+    que es lo que necesita una DB ":memory:".
+    """
+
+    def __init__(self, repo: RepositorioDB, tamano: int = 4):
+        self._cola: queue.Queue[sqlite3.Connection] = queue.Queue(maxsize=tamano)
+        for _ in range(tamano):
+            self._cola.put(repo.conectar(compartida=True))
+
+    @contextmanager
+    def adquirir(self) -> Iterator[sqlite3.Connection]:
+        conn = self._cola.get()
+        try:
+            yield conn
+        finally:
+            # Lo que no se haya confirmado no debe llegar a la siguiente petición
+            if conn.in_transaction:
+                conn.rollback()
+            self._cola.put(conn)
+
+    def cerrar(self) -> None:
+        while True:
+            try:
+                conn = self._cola.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+
+
 # =========================
 # Mercado / datos (yfinance + cache + TTL)
 # =========================
@@ -361,6 +749,10 @@ class ServicioMercado:
     def __init__(self, ruta_resultados: str):
         self.ruta_resultados = ruta_resultados
 
+        # (ticker, intervalo) -> (instante de caducidad en time.monotonic(), precio)
+        self._lock_precios = threading.Lock()
+        self._cache_precios: Dict[Tuple[str, str], Tuple[float, float]] = {}
+
     def _extraer_tickers(self, cargar_tickers_output: Iterable[TickerInput]) -> List[str]:
         tickers: List[str] = []
         for item in cargar_tickers_output:
@@ -381,83 +773,247 @@ class ServicioMercado:
                 out.append(t)
         return out
 
-    def descargar_datos_tickers(self, tickers_db: List[Tuple[str, str]]) -> Dict[str, Dict[str, pd.DataFrame]]:
+    def _descargar_bloque(self, periodo: List[str], bloque: List[str]) -> Dict[str, pd.DataFrame]:
         """
-        IMPORTANTE (Railway): esto puede fallar por rate limit / red.
-        Esta función NO debe romper la app: devolvemos lo que podamos.
+        Descarga un periodo de INTERVALO_PERIODO para un bloque de tickers
+        (como mucho TAMANO_BLOQUE_YF) con una sola petición a Yahoo.
         """
-        tickers = self._extraer_tickers(tickers_db)
-        resultados: Dict[str, Dict[str, pd.DataFrame]] = {}
+        yf_period = periodo[1]
+        intervalo = periodo[2]
+        salida: Dict[str, pd.DataFrame] = {}
+
+        df_all = yf.download(
+            " ".join(tick + ".MC" for tick in bloque),
+            period=yf_period,
+            interval=intervalo,
+            group_by="ticker",
+            threads=True,
+            progress=False,
+            auto_adjust=False,
+            session=SESION_YF,
+        )
+        if df_all is None or df_all.empty:
+            return salida
 
-        for tick in tickers:
-            resultados[tick] = {}
-            for periodo in INTERVALO_PERIODO:
-                clave_periodo = periodo[0]
-                yf_period = periodo[1]
-                intervalo = periodo[2]
+        for tick in bloque:
+            try:
+                df = df_all[tick + ".MC"].dropna(how="all")
+            except KeyError:
+                continue
+            if df.empty:
+                continue
+            if not df.index.is_monotonic_increasing:
+                df = df.sort_index()
+            salida[tick] = self._normalizar_ohlcv(df)
 
-                try:
-                    t = yf.Ticker(tick + ".MC")
-                    df = t.history(period=yf_period, interval=intervalo)
+        return salida
 
-                    # ✅ FIX: antes estabas haciendo df = None siempre
-                    if df is None or df.empty:
-                        continue
+    def _normalizar_ohlcv(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Deja el frame con índice "Datetime" y dtypes fijos antes de guardarlo,
+        para que al leer el parquet no haga falta renombrar ni convertir nada.
+        Al separar la descarga por ticker, Volume suele quedar como float.
+        """
+        df = df.rename_axis(index="Datetime", columns=None)
+        tipos = {col: tipo for col, tipo in TIPOS_OHLCV.items() if col in df.columns}
+        if "Volume" in tipos and df["Volume"].isna().any():
+            tipos["Volume"] = "float64"
+        return df.astype(tipos, copy=False)
 
-                    resultados[tick][clave_periodo] = df.sort_index().copy()
+    def descargar_datos_tickers(
+        self,
+        tickers_db: List[Tuple[str, str]],
+        ttl_seconds: Optional[int] = None,
+    ) -> Dict[str, Dict[str, pd.DataFrame]]:
+        """
+        IMPORTANTE (Railway): esto puede fallar por rate limit / red.
+        Esta función NO debe romper la app: devolvemos lo que podamos.
+
+        Con ttl_seconds, si el último refresco sigue vigente y hay datos en
+        disco, no se toca la red y se devuelven esos datos. Si se descarga
+        algo, se guarda en disco y se marca la hora del refresco.
+
+        Cada (periodo, bloque de tickers) es una tarea independiente y se
+        descargan en paralelo (la espera es de red).
+        """
+        if ttl_seconds is not None and not _ha_expirado_market_cache(ttl_seconds, forzar=True):
+            # Refresco vigente pero sin nada en disco (p. ej. borraron
+            # resultados/): hay que descargar igualmente.
+            datos = self.cargar_datos_desde_disco()
+            if datos:
+                return datos
 
+        tickers = self._extraer_tickers(tickers_db)
+        resultados: Dict[str, Dict[str, pd.DataFrame]] = {tick: {} for tick in tickers}
+        if not tickers:
+            return resultados
+
+        tareas = [
+            (periodo, tickers[i:i + TAMANO_BLOQUE_YF])
+            for periodo in INTERVALO_PERIODO
+            for i in range(0, len(tickers), TAMANO_BLOQUE_YF)
+        ]
+        with ThreadPoolExecutor(max_workers=min(MAX_HILOS_DESCARGA, len(tareas))) as executor:
+            futuros = {
+                executor.submit(self._descargar_bloque, periodo, bloque): periodo[0]
+                for periodo, bloque in tareas
+            }
+            for futuro in as_completed(futuros):
+                clave_periodo = futuros[futuro]
+                try:
+                    por_ticker = futuro.result()
                 except Exception:
-                    # fail-open: si un ticker/periodo falla, seguimos con el resto
+                    # fail-open: si un bloque falla, seguimos con el resto
                     continue
+                for tick, df in por_ticker.items():
+                    resultados[tick][clave_periodo] = df
+
+        if any(resultados.values()):
+            self.guardar_datos_en_disco(resultados)
+            _guardar_market_refresh_ts(time.time())
 
         return resultados
 
+    def _ruta_parquet(self, ticker: str, periodo: str) -> Path:
+        return Path(self.ruta_resultados) / f"{ticker}__{periodo}.parquet"
+
     def guardar_datos_en_disco(self, resultados: Dict[str, Dict[str, pd.DataFrame]]) -> None:
-        salida = {}
+        """
+        Un parquet por (ticker, periodo) dentro de ruta_resultados.
+        Se borran los ficheros que ya no forman parte de la descarga.
+        """
+        carpeta = Path(self.ruta_resultados)
+        carpeta.mkdir(parents=True, exist_ok=True)
+
+        # Restos de una escritura interrumpida (solo escribe quien tiene el
+        # turno de refresco, así que ninguno está a medias ahora)
+        for ruta in carpeta.glob("*.tmp"):
+            ruta.unlink(missing_ok=True)
+
+        escritos = set()
+        guardados: Dict[str, Dict[str, pd.DataFrame]] = {}
         for ticker, data_por_periodo in resultados.items():
             if not isinstance(data_por_periodo, dict) or not data_por_periodo:
                 continue
-            salida[ticker] = {}
             for periodo, df in data_por_periodo.items():
                 if df is None or df.empty:
                     continue
-                df_out = df.copy()
-                df_out.index.name = "Datetime"
-                salida[ticker][periodo] = df_out.reset_index().to_dict(orient="records")
-
-        guardar_json(self.ruta_resultados, salida)
+                df_out = df if df.index.name == "Datetime" else df.rename_axis("Datetime")
+                ruta = self._ruta_parquet(ticker, periodo)
+                # Escritura atómica: los lectores nunca ven un parquet a medias
+                tmp = ruta.with_name(ruta.name + ".tmp")
+                df_out.to_parquet(tmp, engine="pyarrow", compression="snappy")
+                os.replace(tmp, ruta)
+                escritos.add(ruta.name)
+                guardados.setdefault(ticker, {})[periodo] = df_out
+
+        for ruta in carpeta.glob("*.parquet"):
+            if ruta.name not in escritos:
+                ruta.unlink(missing_ok=True)
+
+        # La versión se publica la última: quien la vea cambiar ya tiene
+        # todos los parquet nuevos en disco
+        ruta_version = carpeta / "VERSION"
+        tmp = ruta_version.with_name("VERSION.tmp")
+        tmp.write_text(repr(time.time()), encoding="utf-8")
+        os.replace(tmp, ruta_version)
+
+        # Lo que hay en memoria pasa a ser lo recién guardado
+        global _DATA_CACHE, _DATA_VERSION, _ULTIMOS_CIERRES
+        with _DATA_LOCK:
+            _DATA_CACHE = guardados
+            _DATA_VERSION = self._version_resultados()
+            _ULTIMOS_CIERRES = self._indexar_cierres(guardados)
+
+    def _version_resultados(self) -> Tuple[int, int]:
+        try:
+            st = os.stat(Path(self.ruta_resultados) / "VERSION")
+        except OSError:
+            return (0, 0)
+        return (st.st_mtime_ns, st.st_ino)
 
     def cargar_datos_desde_disco(self) -> Dict[str, Dict[str, pd.DataFrame]]:
-        global TODOS_LOS_DATOS
-        if TODOS_LOS_DATOS == []:
-            data = leer_json(self.ruta_resultados)
-            resultados: Dict[str, Dict[str, pd.DataFrame]] = {}
-
-            for ticker, data_por_periodo in data.items():
-                resultados[ticker] = {}
-                for periodo, registros in data_por_periodo.items():
-                    df = pd.DataFrame(registros)
+        """
+        Devuelve los datos en memoria mientras la versión de disco no cambie;
+        solo se releen los parquet si otro proceso los ha reescrito (doble
+        comprobación con lock para que varios hilos no los lean a la vez).
+        La versión se vuelve a mirar después de leer: si cambió durante la
+        lectura se repite, para no quedarse con una mezcla de datos.
+        """
+        global _DATA_CACHE, _DATA_VERSION, _ULTIMOS_CIERRES
+        datos = _DATA_CACHE
+        if datos is not None and self._version_resultados() == _DATA_VERSION:
+            return datos
+        with _DATA_LOCK:
+            version = self._version_resultados()
+            if _DATA_CACHE is None or version != _DATA_VERSION:
+                for _ in range(3):
+                    antes = version
+                    datos = self._leer_parquets()
+                    version = self._version_resultados()
+                    if version == antes:
+                        break
+                # Si no se estabilizó se guarda la versión previa a la lectura:
+                # la siguiente petición verá que no coincide y volverá a leer.
+                _DATA_CACHE = datos
+                _DATA_VERSION = antes
+                _ULTIMOS_CIERRES = self._indexar_cierres(datos)
+            return _DATA_CACHE
+
+    def _leer_parquets(self) -> Dict[str, Dict[str, pd.DataFrame]]:
+        resultados: Dict[str, Dict[str, pd.DataFrame]] = {}
 
-                    if "Datetime" not in df.columns:
-                        for col in ("Date", "index"):
-                            if col in df.columns:
-                                df = df.rename(columns={col: "Datetime"})
-                                break
+        for ruta in Path(self.ruta_resultados).glob("*.parquet"):
+            ticker, sep, periodo = ruta.stem.rpartition("__")
+            if not sep:
+                continue
+            try:
+                df = pd.read_parquet(ruta, engine="pyarrow")
+            except Exception:
+                continue
+            if not df.index.is_monotonic_increasing:
+                df = df.sort_index()
+            resultados.setdefault(ticker, {})[periodo] = df
 
-                    df["Datetime"] = pd.to_datetime(df["Datetime"], errors="coerce")
-                    df = df.set_index("Datetime")
-                    resultados[ticker][periodo] = df
+        return resultados
 
-            TODOS_LOS_DATOS = resultados
+    @staticmethod
+    def _indexar_cierres(datos: Dict[str, Dict[str, pd.DataFrame]]) -> Dict[Tuple[str, str], float]:
+        cierres: Dict[Tuple[str, str], float] = {}
+        for ticker, data_por_periodo in datos.items():
+            for periodo, df in data_por_periodo.items():
+                if df is not None and not df.empty and "Close" in df.columns:
+                    cierres[(ticker, periodo)] = float(df["Close"].iloc[-1])
+        return cierres
 
-        return TODOS_LOS_DATOS
+    def ultimo_cierre(self, ticker: str, periodo: str) -> Optional[float]:
+        """
+        Los frames en memoria ya están ordenados por fecha, así que el último
+        cierre se precalcula al cargarlos.
+        """
+        return _ULTIMOS_CIERRES.get((ticker, periodo))
 
-    def obtener_precio_tiempo_real(self, ticker: str, intervalo: str = "1m") -> Optional[float]:
+    def obtener_precio_tiempo_real(self, ticker: str, intervalo: str = "1m", force: bool = False) -> Optional[float]:
         """
         Para operar: no debe tirar la app si Yahoo falla.
+        Los precios se reutilizan durante PRECIO_TTL_SECONDS salvo force=True.
         """
+        clave = (ticker, intervalo)
+        if not force:
+            with self._lock_precios:
+                cacheado = self._cache_precios.get(clave)
+            if cacheado is not None and cacheado[0] > time.monotonic():
+                return cacheado[1]
+
+        precio = self._descargar_precio(ticker, intervalo)
+        if precio is not None:
+            with self._lock_precios:
+                self._cache_precios[clave] = (time.monotonic() + PRECIO_TTL_SECONDS, precio)
+        return precio
+
+    def _descargar_precio(self, ticker: str, intervalo: str) -> Optional[float]:
         try:
-            t = yf.Ticker(ticker + ".MC")
+            t = yf.Ticker(ticker + ".MC", session=SESION_YF)
             df = t.history(period="1d", interval=intervalo)
             if df is None or df.empty:
                 return None
@@ -482,63 +1038,174 @@ class ServicioMercado:
 # Render de gráficas mini (sin JS)
 # =========================
 
-class ServicioGraficas:
-    def crear_png_mini_grafica(self, serie: pd.Series, alto_px: int = 70, ancho_px: int = 260) -> bytes:
-        dpi = 100
-        fig_w = max(1.0, float(ancho_px) / dpi)
-        fig_h = max(0.7, float(alto_px) / dpi)
+@lru_cache(maxsize=64)
+def _coordenadas_x(n: int, ancho_px: int) -> Tuple[str, ...]:
+    """
+    Las x de una mini-gráfica solo dependen del nº de puntos y del ancho: se
+    calculan y formatean una vez y se reutilizan en cada render.
+    """
+    return tuple(f"{x:.1f}" for x in np.linspace(0.0, float(ancho_px), n).tolist())
 
-        fig = plt.figure(figsize=(fig_w, fig_h), dpi=dpi)
-        ax = fig.add_subplot(111)
-        ax.set_axis_off()
-        fig.subplots_adjust(0, 0, 1, 1)
 
-        try:
-            ax.plot(serie.index, serie.values)
-        except Exception:
-            pass
+class ServicioGraficas:
+    """
+    Mini-gráficas como SVG (una polilínea): no necesitan ejes ni fuentes, así
+    que se generan a mano sin matplotlib.
+    """
+
+    COLOR_LINEA = "#1f77b4"
+    GROSOR_LINEA = 1.5
+
+    def crear_svg_mini_grafica(self, serie: pd.Series, alto_px: int = 70, ancho_px: int = 260) -> str:
+        valores = np.asarray(serie, dtype=np.float64)
+        valores = valores[np.isfinite(valores)]
+
+        puntos = ""
+        if valores.size:
+            margen = self.GROSOR_LINEA
+            xs = _coordenadas_x(valores.size, ancho_px)
+            rango = float(np.ptp(valores)) or 1.0
+            ys = (alto_px - margen) - (valores - valores.min()) / rango * (alto_px - 2 * margen)
+            puntos = " ".join(f"{x},{y:.1f}" for x, y in zip(xs, ys.tolist()))
+
+        return (
+            f'<svg xmlns="http://www.w3.org/2000/svg" class="mini" '
+            f'width="{ancho_px}" height="{alto_px}" viewBox="0 0 {ancho_px} {alto_px}" preserveAspectRatio="none">'
+            f'<polyline fill="none" stroke="{self.COLOR_LINEA}" stroke-width="{self.GROSOR_LINEA}" '
+            f'stroke-linejoin="round" points="{puntos}"/>'
+            f"</svg>"
+        )
+
 
-        buf = io.BytesIO()
-        fig.savefig(buf, format="png", dpi=dpi, transparent=True)
-        plt.close(fig)
-        return buf.getvalue()
+# Mini-gráfica de un ticker sin datos (línea plana), calculada una vez
+SVG_MINI_VACIA = ServicioGraficas().crear_svg_mini_grafica(pd.Series([0.0, 0.0, 0.0]))
 
 
 # =========================
 # Helpers TTL refresh (NUEVO)
 # =========================
 
-def _leer_market_refresh_ts() -> Optional[float]:
-    data = leer_json(RUTA_MARKET_REFRESH)
+# El timestamp del último refresco vive en memoria; el fichero solo se lee al
+# arrancar el proceso y se reescribe cuando hay un refresco real.
+_MARKET_TS_LOCK = threading.Lock()
+# Evita que varias peticiones refresquen el mercado a la vez
+_REFRESH_LOCK = threading.Lock()
+_LAST_REFRESH_TS: Optional[float] = None
+# mtime del fichero cuando se leyó (None = aún sin leer) e instante
+# (time.monotonic) de la última comprobación
+_LAST_REFRESH_MTIME_NS: Optional[int] = None
+_LAST_REFRESH_COMPROBADO = 0.0
+
+
+def _mtime_market_refresh() -> int:
     try:
-        return float(data.get("ts", 0.0)) or None
-    except Exception:
-        return None
+        return os.stat(RUTA_MARKET_REFRESH).st_mtime_ns
+    except OSError:
+        return 0
+
+
+def _leer_market_refresh_ts(releer: bool = False, forzar: bool = False) -> Optional[float]:
+    """
+    Con releer=True se mira si otro worker ha reescrito el fichero, como
+    mucho una vez cada RELECTURA_REFRESH_SEGUNDOS (forzar=True se salta esa
+    espera), y el JSON solo se vuelve a parsear si su mtime ha cambiado.
+    """
+    global _LAST_REFRESH_TS, _LAST_REFRESH_MTIME_NS, _LAST_REFRESH_COMPROBADO
+    with _MARKET_TS_LOCK:
+        if _LAST_REFRESH_MTIME_NS is not None and not forzar:
+            if not releer or time.monotonic() - _LAST_REFRESH_COMPROBADO < RELECTURA_REFRESH_SEGUNDOS:
+                return _LAST_REFRESH_TS
+        _LAST_REFRESH_COMPROBADO = time.monotonic()
+        mtime = _mtime_market_refresh()
+        if mtime == _LAST_REFRESH_MTIME_NS:
+            return _LAST_REFRESH_TS
+
+        data = leer_json(RUTA_MARKET_REFRESH)
+        try:
+            _LAST_REFRESH_TS = float(data.get("ts", 0.0)) or None
+        except Exception:
+            _LAST_REFRESH_TS = None
+        _LAST_REFRESH_MTIME_NS = mtime
+        return _LAST_REFRESH_TS
 
 
 def _guardar_market_refresh_ts(ts: float) -> None:
+    global _LAST_REFRESH_TS, _LAST_REFRESH_MTIME_NS
     guardar_json(RUTA_MARKET_REFRESH, {"ts": ts})
+    with _MARKET_TS_LOCK:
+        _LAST_REFRESH_TS = ts
+        _LAST_REFRESH_MTIME_NS = _mtime_market_refresh()
 
 
-def _ha_expirado_market_cache(ttl_seconds: int) -> bool:
+def _ha_expirado_market_cache(ttl_seconds: int, forzar: bool = False) -> bool:
+    """
+    forzar=True para la comprobación que se hace ya con el turno de refresco:
+    mira el fichero sin esperar a RELECTURA_REFRESH_SEGUNDOS, por si otro
+    worker acaba de refrescar (solo ocurre una vez por refresco).
+    """
     ts = _leer_market_refresh_ts()
+    if not ts or (time.time() - ts) > ttl_seconds:
+        # Con varios workers otro proceso puede haber refrescado ya: antes de
+        # darlo por caducado se relee el fichero.
+        ts = _leer_market_refresh_ts(releer=True, forzar=forzar)
     if not ts:
         return True
     return (time.time() - ts) > ttl_seconds
 
 
+@contextmanager
+def _turno_refresco() -> Iterator[bool]:
+    """
+    True si a este hilo le toca refrescar el mercado. Dentro del proceso lo
+    decide _REFRESH_LOCK; entre workers de gunicorn, un flock sobre
+    RUTA_REFRESH_LOCK (solo POSIX: en Windows basta con el lock de hilos).
+    """
+    if not _REFRESH_LOCK.acquire(blocking=False):
+        yield False
+        return
+    fichero = None
+    try:
+        if fcntl is not None:
+            fichero = open(RUTA_REFRESH_LOCK, "a")
+            try:
+                fcntl.flock(fichero, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                yield False
+                return
+        yield True
+    finally:
+        if fichero is not None:
+            fichero.close()  # cerrar libera el flock
+        _REFRESH_LOCK.release()
+
+
 # =========================
 # App Flask
 # =========================
 
+class SesionBlake2(SecureCookieSessionInterface):
+    """
+    Cookie de sesión firmada con HMAC-BLAKE2b en vez de HMAC-SHA1: se
+    verifica en cada petición autenticada y BLAKE2b es más rápido.
+    """
+    digest_method = staticmethod(hashlib.blake2b)
+
+
 def create_app() -> Flask:
     app = Flask(__name__)
     app.secret_key = CLAVE_SESION
+    app.session_interface = SesionBlake2()
 
     repo = RepositorioDB(RUTA_DB)
     mercado = ServicioMercado(RUTA_RESULTADOS)
     graficas = ServicioGraficas()
 
+    pool = PoolConexiones(repo, tamano=1 if RUTA_DB == ":memory:" else TAMANO_POOL_DB)
+    atexit.register(pool.cerrar)
+
+    with pool.adquirir() as conn:
+        repo.asegurar_esquema(conn)
+
     # ✅ Healthcheck rápido (Railway tests)
     @app.get("/healthz")
     def healthz():
@@ -563,31 +1230,33 @@ def create_app() -> Flask:
         - Si expira -> intenta refrescar
         - Si refresco falla -> vuelve a cache y NO rompas la página
         """
-        tickers_db = repo.leer_tickers(conn)
-
         # 1) Si hay cache y está fresca, la devolvemos
-        if existe_archivo(RUTA_RESULTADOS) and not _ha_expirado_market_cache(MARKET_REFRESH_TTL_SECONDS):
+        if existe_directorio(RUTA_RESULTADOS) and not _ha_expirado_market_cache(MARKET_REFRESH_TTL_SECONDS):
             datos = mercado.cargar_datos_desde_disco()
             if datos:
                 return datos
 
         # 2) Si hay cache aunque esté vieja, la cargamos como fallback
         fallback = {}
-        if existe_archivo(RUTA_RESULTADOS):
+        if existe_directorio(RUTA_RESULTADOS):
             try:
                 fallback = mercado.cargar_datos_desde_disco() or {}
             except Exception:
                 fallback = {}
 
-        # 3) Intentar refrescar (puede fallar por yfinance)
-        try:
-            datos_nuevos = mercado.descargar_datos_tickers(tickers_db)
-            if datos_nuevos:
-                mercado.guardar_datos_en_disco(datos_nuevos)
-                _guardar_market_refresh_ts(time.time())
-                return datos_nuevos
-        except Exception:
-            pass
+        # 3) Intentar refrescar (puede fallar por yfinance). Solo refresca una
+        #    petición a la vez (también entre workers); las demás sirven lo que
+        #    haya mientras tanto.
+        with _turno_refresco() as me_toca:
+            if not me_toca:
+                return fallback or {}
+            try:
+                tickers_db = repo.leer_tickers(conn)
+                datos_nuevos = mercado.descargar_datos_tickers(tickers_db, ttl_seconds=MARKET_REFRESH_TTL_SECONDS)
+                if any(datos_nuevos.values()):
+                    return datos_nuevos
+            except Exception:
+                pass
 
         # 4) Fail-open: si no se pudo refrescar, devolvemos lo que haya
         if fallback:
@@ -627,13 +1296,10 @@ def create_app() -> Flask:
             flash("Usuario_id inválido.", "error")
             return redirect(url_for("login"))
 
-        conn = repo.conectar()
-        try:
+        with pool.adquirir() as conn:
             if not repo.db_existe_usuario(conn, usuario_id):
                 flash("No existe ese usuario_id en la BBDD.", "error")
                 return redirect(url_for("login"))
-        finally:
-            conn.close()
 
         session["usuario_id"] = usuario_id
         return redirect(url_for("valores"))
@@ -649,9 +1315,8 @@ def create_app() -> Flask:
         if resp:
             return resp
 
-        periodo = (request.args.get("periodo") or "MAX").upper().strip()
-        periodos_validos = [p[0] for p in INTERVALO_PERIODO]
-        if periodo not in periodos_validos:
+        periodo = leer_mayusculas(request.args, "periodo", "MAX")
+        if periodo not in PERIODOS_VALIDOS:
             periodo = "MAX"
 
         refresco_seg = request.args.get("refresco", "900").strip()
@@ -663,34 +1328,31 @@ def create_app() -> Flask:
         uid = usuario_id_actual()
         assert uid is not None
 
-        conn = repo.conectar()
-        try:
-            tickers_db = repo.leer_tickers(conn)
-            empresas = {t: e for e, t in tickers_db}
+        with pool.adquirir() as conn:
+            empresas, tickers_ordenados = repo.leer_empresas(conn)
 
-            datos = cargar_datos_mercado(conn)
+            cargar_datos_mercado(conn)
+            version = _DATA_VERSION
 
             portfolio = repo.db_get_posiciones(conn)
             usuario_nombre, cash = repo.db_get_usuario(conn, uid)
+            costes_medios = repo.db_coste_medio_todos(conn, uid)
+            autos = repo.db_get_auto_todos(conn, uid)
 
             registros: List[RegistroTickerUI] = []
-            for ticker in sorted(empresas.keys()):
+            for ticker in tickers_ordenados:
                 empresa = empresas.get(ticker, "Desconocida")
                 acciones = int(portfolio.get(ticker, 0))
 
-                df = mercado.obtener_df(datos, ticker, periodo)
-                precio_actual = None
-                if df is not None and not df.empty and "Close" in df.columns:
-                    df = df.sort_index()
-                    precio_actual = float(df["Close"].iloc[-1])
+                precio_actual = mercado.ultimo_cierre(ticker, periodo)
+                mini_svg = _svg_mini(ticker, periodo, PUNTOS_MINI_GRAFICA, version)
 
                 beneficio = None
                 if precio_actual is not None and acciones > 0:
-                    coste_medio = repo.db_coste_medio_posicion(conn, uid, ticker)
+                    coste_medio = costes_medios.get(ticker, 0.0)
                     beneficio = (precio_actual - coste_medio) * acciones
 
-                # (TP/SL siguen igual)
-                tp, sl = repo.db_get_auto_venta_compra_activa(conn, uid, ticker)
+                tp, sl = autos.get(ticker, (None, None))
 
                 registros.append(
                     RegistroTickerUI(
@@ -701,6 +1363,7 @@ def create_app() -> Flask:
                         beneficio=beneficio,
                         tp=tp,
                         sl=sl,
+                        mini_svg=mini_svg,
                     )
                 )
 
@@ -709,12 +1372,10 @@ def create_app() -> Flask:
                 usuario_nombre=usuario_nombre,
                 saldo=cash,
                 periodo=periodo,
-                periodos=periodos_validos,
+                periodos=PERIODOS,
                 registros=registros,
                 refresco_seg=refresco_seg_i,
             )
-        finally:
-            conn.close()
 
     @app.get("/clasificacion")
     def clasificacion():
@@ -741,11 +1402,31 @@ def create_app() -> Flask:
     # Rutas: operaciones (POST)
     # =========================
 
+    def precio_req(ticker: str, intervalo: str = "1m") -> Optional[float]:
+        """
+        Precio en tiempo real memoizado dentro de la petición actual (flask.g),
+        por encima de la cache con TTL del servicio de mercado.
+        """
+        cache = g.setdefault("_precio", {})
+        clave = (ticker, intervalo)
+        if clave not in cache:
+            cache[clave] = mercado.obtener_precio_tiempo_real(ticker, intervalo=intervalo)
+        return cache[clave]
+
     def _obtener_precio_operacion() -> Optional[float]:
-        ticker = (request.form.get("ticker") or "").strip().upper()
+        ticker = leer_ticker(request.form)
         if not ticker:
             return None
-        return mercado.obtener_precio_tiempo_real(ticker, intervalo="1m")
+
+        # Con un refresco reciente, el último cierre de velas de 1m del periodo
+        # "D" vale como precio de operación y nos ahorramos ir a Yahoo.
+        if not _ha_expirado_market_cache(PRECIO_DESDE_MERCADO_SEGUNDOS):
+            mercado.cargar_datos_desde_disco()
+            cierre = mercado.ultimo_cierre(ticker, "D")
+            if cierre is not None:
+                return cierre
+
+        return precio_req(ticker, intervalo="1m")
 
     @app.post("/operar/comprar")
     def operar_comprar():
@@ -753,13 +1434,10 @@ def create_app() -> Flask:
         if resp:
             return resp
 
-        ticker = (request.form.get("ticker") or "").strip().upper()
-        periodo = (request.form.get("periodo") or "MAX").strip().upper()
-        cantidad_txt = (request.form.get("cantidad") or "1").strip()
-
-        try:
-            cantidad = max(1, int(cantidad_txt))
-        except Exception:
+        ticker = leer_ticker(request.form)
+        periodo = leer_mayusculas(request.form, "periodo", "MAX")
+        cantidad = leer_entero(request.form, "cantidad", 1)
+        if cantidad is None:
             flash("Cantidad inválida.", "error")
             return redirect(url_for("valores", periodo=periodo))
 
@@ -771,8 +1449,7 @@ def create_app() -> Flask:
             flash("No se pudo obtener precio en tiempo real (Yahoo). Prueba más tarde.", "error")
             return redirect(url_for("valores", periodo=periodo))
 
-        conn = repo.conectar()
-        try:
+        with pool.adquirir() as conn, repo.transaccion(conn):
             cash = repo.db_get_saldo(conn, uid)
             coste = precio * cantidad + COMISION_POR_OPERACION
             if cash < coste:
@@ -786,12 +1463,9 @@ def create_app() -> Flask:
             repo.db_set_saldo(conn, uid, cash - coste)
             repo.db_set_posicion(conn, ticker, acciones_nuevas)
             repo.db_insert_compra(conn, uid, ticker, cantidad, precio)
-            conn.commit()
 
             flash(f"Compra OK: {ticker} x{cantidad} a {precio:.3f} (comisión {COMISION_POR_OPERACION:.2f} €).", "ok")
             return redirect(url_for("valores", periodo=periodo))
-        finally:
-            conn.close()
 
     @app.post("/operar/vender")
     def operar_vender():
@@ -799,13 +1473,10 @@ def create_app() -> Flask:
         if resp:
             return resp
 
-        ticker = (request.form.get("ticker") or "").strip().upper()
-        periodo = (request.form.get("periodo") or "MAX").strip().upper()
-        cantidad_txt = (request.form.get("cantidad") or "1").strip()
-
-        try:
-            cantidad = max(1, int(cantidad_txt))
-        except Exception:
+        ticker = leer_ticker(request.form)
+        periodo = leer_mayusculas(request.form, "periodo", "MAX")
+        cantidad = leer_entero(request.form, "cantidad", 1)
+        if cantidad is None:
             flash("Cantidad inválida.", "error")
             return redirect(url_for("valores", periodo=periodo))
 
@@ -817,8 +1488,7 @@ def create_app() -> Flask:
             flash("No se pudo obtener precio en tiempo real (Yahoo). Prueba más tarde.", "error")
             return redirect(url_for("valores", periodo=periodo))
 
-        conn = repo.conectar()
-        try:
+        with pool.adquirir() as conn, repo.transaccion(conn):
             portfolio = repo.db_get_posiciones(conn)
             acciones_actuales = int(portfolio.get(ticker, 0))
             if acciones_actuales < cantidad:
@@ -836,12 +1506,9 @@ def create_app() -> Flask:
             repo.db_set_posicion(conn, ticker, acciones_nuevas)
 
             repo.db_cerrar_compras(conn, uid, ticker, cantidad, precio)
-            conn.commit()
 
             flash(f"Venta OK: {ticker} x{cantidad} a {precio:.3f} (comisión {COMISION_POR_OPERACION:.2f} €).", "ok")
             return redirect(url_for("valores", periodo=periodo))
-        finally:
-            conn.close()
 
     @app.post("/operar/guardar_auto")
     def operar_guardar_auto():
@@ -849,25 +1516,21 @@ def create_app() -> Flask:
         if resp:
             return resp
 
-        ticker = (request.form.get("ticker") or "").strip().upper()
-        periodo = (request.form.get("periodo") or "MAX").strip().upper()
+        ticker = leer_ticker(request.form)
+        periodo = leer_mayusculas(request.form, "periodo", "MAX")
         tp = normalizar_float_texto(request.form.get("tp") or "")
         sl = normalizar_float_texto(request.form.get("sl") or "")
 
         uid = usuario_id_actual()
         assert uid is not None
 
-        conn = repo.conectar()
-        try:
+        with pool.adquirir() as conn, repo.transaccion(conn):
             repo.db_set_auto_venta_compra_activa(conn, uid, ticker, tp, sl)
-            conn.commit()
             flash(
                 f"Auto-venta actualizada para {ticker} (TP={tp if tp is not None else '--'} / SL={sl if sl is not None else '--'}).",
                 "ok",
             )
             return redirect(url_for("valores", periodo=periodo))
-        finally:
-            conn.close()
 
     @app.post("/operar/eliminar_auto")
     def operar_eliminar_auto():
@@ -875,20 +1538,16 @@ def create_app() -> Flask:
         if resp:
             return resp
 
-        ticker = (request.form.get("ticker") or "").strip().upper()
-        periodo = (request.form.get("periodo") or "MAX").strip().upper()
+        ticker = leer_ticker(request.form)
+        periodo = leer_mayusculas(request.form, "periodo", "MAX")
 
         uid = usuario_id_actual()
         assert uid is not None
 
-        conn = repo.conectar()
-        try:
+        with pool.adquirir() as conn, repo.transaccion(conn):
             repo.db_clear_auto_venta_compra_activa(conn, uid, ticker)
-            conn.commit()
             flash(f"Auto-venta eliminada para {ticker}.", "ok")
             return redirect(url_for("valores", periodo=periodo))
-        finally:
-            conn.close()
 
     # =========================
     # Rutas: imágenes (mini-gráficas)
@@ -900,33 +1559,54 @@ def create_app() -> Flask:
         if resp:
             return resp
 
-        ticker = (request.args.get("ticker") or "").strip().upper()
-        periodo = (request.args.get("periodo") or "MAX").strip().upper()
-        puntos_txt = (request.args.get("puntos") or "60").strip()
-
-        try:
-            puntos = max(20, int(puntos_txt))
-        except Exception:
-            puntos = 60
+        ticker = leer_ticker(request.args)
+        periodo = leer_mayusculas(request.args, "periodo", "MAX")
+        if periodo not in PERIODOS_VALIDOS:
+            periodo = "MAX"
+        puntos = leer_entero(request.args, "puntos", PUNTOS_MINI_GRAFICA, minimo=PUNTOS_MINI_GRAFICA_MIN)
+        puntos = min(puntos or PUNTOS_MINI_GRAFICA, PUNTOS_MINI_GRAFICA_MAX)
 
         if not ticker:
             abort(400)
 
-        conn = repo.conectar()
-        try:
-            datos = cargar_datos_mercado(conn)
-            df = mercado.obtener_df(datos, ticker, periodo)
-            if df is None or df.empty or "Close" not in df.columns:
-                serie = pd.Series([0, 0, 0], index=pd.date_range(end=datetime.now(), periods=3))
-                png = graficas.crear_png_mini_grafica(serie)
-                return Response(png, mimetype="image/png")
+        with pool.adquirir() as conn:
+            cargar_datos_mercado(conn)
 
-            df = df.sort_index()
-            serie = df["Close"].tail(puntos)
-            png = graficas.crear_png_mini_grafica(serie)
-            return Response(png, mimetype="image/png")
-        finally:
-            conn.close()
+        # Sin datos para el ticker: la línea plana es siempre la misma
+        if mercado.ultimo_cierre(ticker, periodo) is None:
+            resp = Response(SVG_MINI_VACIA, mimetype="image/svg+xml")
+            resp.cache_control.public = True
+            resp.cache_control.max_age = MINI_GRAFICA_VACIA_MAX_AGE
+            return resp
+
+        # Pedir más puntos de los que tiene la serie da la misma gráfica
+        df = mercado.obtener_df(_DATA_CACHE or {}, ticker, periodo)
+        if df is not None:
+            puntos = min(puntos, len(df))
+
+        # Misma versión de los datos en disco => misma gráfica, así que el
+        # navegador puede revalidar con 304.
+        version = _DATA_VERSION
+        etag = hashlib.blake2b(f"{ticker}|{periodo}|{puntos}|{version}".encode(), digest_size=16).hexdigest()
+        if etag in request.if_none_match:
+            resp = Response(status=304)
+        else:
+            resp = Response(_svg_mini(ticker, periodo, puntos, version), mimetype="image/svg+xml")
+            if version[0]:
+                resp.last_modified = datetime.fromtimestamp(version[0] / 1e9, tz=timezone.utc)
+        resp.set_etag(etag)
+        resp.cache_control.private = True
+        resp.cache_control.max_age = MINI_GRAFICA_MAX_AGE
+        return resp
+
+    @lru_cache(maxsize=256)
+    def _svg_mini(ticker: str, periodo: str, puntos: int, version: Tuple[int, int]) -> str:
+        # version solo forma parte de la clave: invalida al cambiar los datos
+        df = mercado.obtener_df(_DATA_CACHE or {}, ticker, periodo)
+        if df is None or df.empty or "Close" not in df.columns:
+            return SVG_MINI_VACIA
+
+        return graficas.crear_svg_mini_grafica(df["Close"].tail(puntos))
 
     return app
 